@@ -1,5 +1,9 @@
 from binascii import hexlify, unhexlify
+import bisect
+import hashlib
 import os
+import stat
+import struct
 import tempfile
 import time
 import zlib
@@ -9,8 +13,8 @@ from Queue import Queue
 
 # for the object store
 from dulwich.object_store import PackBasedObjectStore, ShaFile, ObjectStoreIterator
-from dulwich.objects import Blob
-from dulwich.pack import PackData, iter_sha1, write_pack_index_v2, Pack, load_pack_index_file
+from dulwich.objects import Blob, Commit, Tag, Tree, S_ISGITLINK
+from dulwich.pack import PackData, iter_sha1, write_pack_index_v2, Pack, load_pack_index_file, apply_delta, OFS_DELTA, REF_DELTA
 from cStringIO import StringIO
 
 # for the refstore
@@ -121,6 +125,144 @@ class S3RefsContainer(RefsContainer, S3PrefixFS):
 		return True
 
 
+class S3Pack(Pack):
+	"""A pack stored on S3, able to read single objects using ranged requests.
+
+	The index is downloaded in full, objects are read by fetching only their entries
+	from the pack file. An entry ends where the next one in the index starts. Fetched
+	data is split up and kept per entry, so entries read ahead or fetched together
+	with others do not cause additional requests. Entry data is dropped as soon as
+	the entry is decoded."""
+
+	max_range_gap = 16 * 1024
+	"""Entries closer than this are fetched with a single request when prefetching."""
+
+	readahead = 64 * 1024
+	"""Minimum size of a single request. Commits and trees are usually stored next
+	to each other, reading ahead avoids a request per object. Bytes wasted on
+	unwanted blobs are bounded by this per request."""
+
+	size_probe = 512
+	"""Number of bytes read from the start of an entry to determine its size."""
+
+	def __init__(self, basename, bucket, size):
+		super(S3Pack, self).__init__(basename)
+		self.bucket = bucket
+		self.size = size
+		self._offsets = None
+		self._entries = {}
+		self._resolved = {}
+
+	def _entry_offsets(self):
+		if self._offsets is None:
+			self._offsets = sorted(entry[1] for entry in self.index.iterentries())
+		return self._offsets
+
+	def _entry_end(self, offset):
+		offsets = self._entry_offsets()
+		i = bisect.bisect_right(offsets, offset)
+		# the last entry is followed by the 20 byte pack checksum
+		return offsets[i] if i < len(offsets) else self.size - 20
+
+	def _fetch(self, start, end):
+		"""Download a byte range starting at an entry, storing the data of every
+		entry (or the part of it) within the range."""
+		log.debug('Fetching bytes %d-%d of %s.pack' % (start, end - 1, self._basename))
+		key = self.bucket.new_key('%s.pack' % self._basename)
+		data = key.get_contents_as_string(headers = {'Range': 'bytes=%d-%d' % (start, end - 1)})
+
+		offsets = self._entry_offsets()
+		for i in xrange(bisect.bisect_left(offsets, start), len(offsets)):
+			offset = offsets[i]
+			if offset >= end: break
+			entry = data[offset - start:min(self._entry_end(offset), end) - start]
+			if len(entry) > len(self._entries.get(offset, '')): self._entries[offset] = entry
+
+	def _cached(self, offset, length):
+		return len(self._entries.get(offset, '')) >= length
+
+	def _read(self, offset, length):
+		"""Read the first length bytes of the entry at offset."""
+		if not self._cached(offset, length): self._fetch(offset, offset + length)
+
+		return self._entries[offset][:length]
+
+	def _read_entry(self, offset):
+		return self._read(offset, self._entry_end(offset) - offset)
+
+	def drop_prefetched(self):
+		"""Forget entry data fetched but not decoded, e.g. delta bases or parts of blobs
+		which were read ahead or downloaded along with nearby entries."""
+		self._entries.clear()
+
+	def prefetch(self, offsets, readahead = False, probe = None):
+		"""Download the entries at offsets, merging nearby entries into one request.
+		If probe is given, only the first probe bytes of each entry are downloaded."""
+		ranges = []
+		for offset in sorted(set(offsets)):
+			end = self._entry_end(offset)
+			if probe is not None: end = min(end, offset + probe)
+			if self._cached(offset, end - offset): continue
+
+			if ranges and offset - ranges[-1][1] <= self.max_range_gap:
+				ranges[-1][1] = max(ranges[-1][1], end)
+			else:
+				ranges.append([offset, end])
+
+		for start, end in ranges:
+			if readahead: end = max(end, min(start + self.readahead, self.size - 20))
+			self._fetch(start, end)
+
+	def get_raw_ranged(self, offset, base = False):
+		"""Read the object at offset, resolving deltas. Returns a (type_num, raw string)
+		tuple, like get_raw(). The entry's data is dropped afterwards, unless it is
+		read as a delta base."""
+		if offset in self._resolved: return self._resolved[offset]
+
+		data = self._read_entry(offset)
+		if not base: del self._entries[offset]
+		type_num, size, pos = unpack_entry_header(data)
+
+		if OFS_DELTA == type_num:
+			delta_offset, pos = unpack_ofs_delta_offset(data, pos)
+			base_type, base_raw = self.get_raw_ranged(offset - delta_offset, True)
+		elif REF_DELTA == type_num:
+			base_type, base_raw = self.get_raw_ranged(self.index.object_index(data[pos:pos + 20]), True)
+			pos += 20
+
+		raw = zlib.decompress(data[pos:])
+		if type_num in (OFS_DELTA, REF_DELTA):
+			type_num, raw = base_type, apply_delta(base_raw, raw)
+			# newer dulwich versions return a list of chunks
+			if isinstance(raw, list): raw = ''.join(raw)
+
+		# commits and trees are small and often used as delta bases, keep them around
+		if Blob.type_num != type_num: self._resolved[offset] = (type_num, raw)
+
+		return type_num, raw
+
+	def get_size_ranged(self, offset):
+		"""Determine the uncompressed size of the object at offset, reading only the
+		start of its entry."""
+		end = self._entry_end(offset)
+		data = self._read(offset, min(end - offset, self.size_probe))
+		# a partial entry is of no use once the size is known
+		if len(data) < end - offset: del self._entries[offset]
+
+		type_num, size, pos = unpack_entry_header(data)
+		if type_num not in (OFS_DELTA, REF_DELTA): return size
+
+		# a delta starts with the sizes of its base and its result
+		pos = unpack_ofs_delta_offset(data, pos)[1] if OFS_DELTA == type_num else pos + 20
+		delta = zlib.decompressobj().decompress(data[pos:])
+		if len(delta) < 20 and len(data) < end - offset:
+			# both sizes take up to 10 bytes, the probe did not contain enough of them
+			delta = zlib.decompress(self._read_entry(offset)[pos:])
+
+		base_size, delta_pos = unpack_delta_size(delta, 0)
+		return unpack_delta_size(delta, delta_pos)[0]
+
+
 class S3ObjectStore(PackBasedObjectStore, S3PrefixFS):
 	"""Storage backend on an Amazon S3 bucket.
 
@@ -152,7 +294,7 @@ class S3ObjectStore(PackBasedObjectStore, S3PrefixFS):
 				log.debug('Removed temporary file %s' % path)
 		return f, commit
 
-	def _create_pack(self, path):
+	def _create_pack(self, path, size):
 		def data_loader():
 			# read and writable temporary file
 			pack_tmpfile = tempfile.NamedTemporaryFile()
@@ -184,7 +326,7 @@ class S3ObjectStore(PackBasedObjectStore, S3PrefixFS):
 
 			return load_pack_index_file(index_tmpfile.name, index_tmpfile)
 
-		p = Pack(path)
+		p = S3Pack(path, self.bucket, size)
 
 		p._data_load = data_loader
 		p._idx_load = idx_loader
@@ -227,9 +369,10 @@ class S3ObjectStore(PackBasedObjectStore, S3PrefixFS):
 		finally:
 			os.remove(index_path)
 
+		pack_size = os.path.getsize(path)
 		p.close()
 
-		return self._create_pack(key_prefix)
+		return self._create_pack(key_prefix, pack_size)
 
 	def __iter__(self):
 		return (k.name[-41:-39] + k.name[-38:] for k in self._s3_keys_iter())
@@ -247,7 +390,7 @@ class S3ObjectStore(PackBasedObjectStore, S3PrefixFS):
 		for key in self.bucket.get_all_keys(prefix = '%sobjects/pack/' % self.prefix):
 			if key.name.endswith('.pack'):
 				log.debug('Found key %r' % key)
-				packs.append(self._create_pack(key.name[:-len('.pack')]))
+				packs.append(self._create_pack(key.name[:-len('.pack')], key.size))
 
 		self._pack_cache_time = time.time()
 		return packs
@@ -266,6 +409,117 @@ class S3ObjectStore(PackBasedObjectStore, S3PrefixFS):
 		   still cause it to be uploaded, overwriting the old with the same data."""
 		self.add_objects([obj])
 
+	def _find_packed(self, sha):
+		for pack in self.packs:
+			try:
+				return pack, pack.index.object_index(sha)
+			except KeyError:
+				pass
+		return None, None
+
+	def prefetch(self, shas, readahead = False, probe = None):
+		"""Download the pack entries of shas in as few requests as possible."""
+		offsets = {}
+		for sha in shas:
+			pack, offset = self._find_packed(sha)
+			if pack: offsets.setdefault(pack, []).append(offset)
+
+		for pack, pack_offsets in offsets.iteritems():
+			pack.prefetch(pack_offsets, readahead, probe)
+
+	def drop_prefetched(self):
+		for pack in self.packs:
+			pack.drop_prefetched()
+
+	def get_ranged(self, sha):
+		"""Like __getitem__, but only downloads the pack entries needed for the object
+		instead of whole packs."""
+		pack, offset = self._find_packed(sha)
+		if not pack: return self[sha]
+
+		return ShaFile.from_raw_string(*pack.get_raw_ranged(offset))
+
+	def get_size_ranged(self, sha):
+		"""Determine the size of an object, without downloading all of it."""
+		pack, offset = self._find_packed(sha)
+		if not pack: return len(self[sha].as_raw_string())
+
+		return pack.get_size_ranged(offset)
+
+	def iter_filtered_objects(self, wants, have, blob_limit = None):
+		"""Iterate over all objects reachable from wants, omitting large blobs.
+
+		Yields (object, path) tuples, suitable for writing a pack. Objects for which
+		have(sha) is true are not descended into, unless explicitly wanted. Blobs of
+		blob_limit bytes or more are left out; with a limit of 0, blobs are skipped
+		without being read at all, otherwise only the start of their pack entries is
+		read to determine their size. Wanted objects are always included, this is how
+		missing blobs are fetched on demand.
+
+		Objects are read with ranged requests, one level of the graph at a time, so
+		that the entries of a level can be fetched in a few requests and packs are
+		never downloaded as a whole. The commit graph is walked first: commits are
+		usually stored next to each other and are read ahead, while trees are mixed
+		with blobs and only their own entries are fetched. Data fetched for a level of
+		trees is dropped once the level is done, so memory use does not grow with the
+		size of blobs passed over."""
+		# wanted objects are marked seen up front, so they are never reached (and
+		# possibly filtered out) through a tree before being handled as wanted
+		seen = set(wants)
+		commits = [(sha, None, True, False) for sha in seen]
+		trees = []
+
+		def add_todo(queue, sha, path, blob = False):
+			if sha in seen: return
+			seen.add(sha)
+			queue.append((sha, path, False, blob))
+
+		while commits or trees:
+			if commits:
+				level, commits, readahead = commits, [], True
+			else:
+				level, trees, readahead = trees, [], False
+
+			level = [entry for entry in level if entry[2] or not have(entry[0])]
+
+			if blob_limit:
+				# size up blobs before downloading them, large ones are never fetched
+				blobs = [sha for sha, path, wanted, blob in level if blob]
+				self.prefetch(blobs, probe = S3Pack.size_probe)
+				large = set(sha for sha in blobs if self.get_size_ranged(sha) >= blob_limit)
+				for sha, path, wanted, blob in level:
+					if sha in large: log.debug('Filtered out Blob %s (%s)' % (sha, path))
+				level = [entry for entry in level if entry[0] not in large]
+
+			self.prefetch((sha for sha, path, wanted, blob in level), readahead)
+
+			for sha, path, wanted, blob in level:
+				obj = self.get_ranged(sha)
+				type_num = obj.get_type()
+
+				if Tree.type_num == type_num:
+					for name, mode, hexsha in obj.iteritems():
+						if S_ISGITLINK(mode): continue
+						is_blob = not stat.S_ISDIR(mode)
+						if 0 == blob_limit and is_blob: continue
+						add_todo(trees, hexsha, os.path.join(path, name) if path else name, is_blob)
+				elif Commit.type_num == type_num:
+					add_todo(trees, obj.tree, None)
+					for parent in obj.parents: add_todo(commits, parent, None)
+				elif Tag.type_num == type_num:
+					# tagged blobs and trees go through the same filter as those in trees
+					target_class, target = obj.object
+					if Blob.type_num == target_class.type_num:
+						if 0 != blob_limit: add_todo(trees, target, None, True)
+					elif Tree.type_num == target_class.type_num:
+						add_todo(trees, target, None)
+					else:
+						add_todo(commits, target, None)
+
+				yield obj, path
+
+			if not readahead: self.drop_prefetched()
+
 
 class S3CachedObjectStore(S3ObjectStore):
 	def __init__(self, *args, **kwargs):
@@ -308,6 +562,121 @@ class S3Repo(BaseRepo):
 		self.refs.set_symbolic_ref('HEAD', 'refs/heads/master')
 
 
+def unpack_entry_header(data):
+	"""Parse the header of a pack entry. Returns (type_num, size, header length)."""
+	byte = ord(data[0])
+	type_num = (byte >> 4) & 0x07
+	size = byte & 0x0f
+	shift = 4
+	pos = 1
+	while byte & 0x80:
+		byte = ord(data[pos])
+		size |= (byte & 0x7f) << shift
+		shift += 7
+		pos += 1
+	return type_num, size, pos
+
+def pack_entry_header(type_num, size):
+	"""Build the header of an undeltified pack entry."""
+	byte = (type_num << 4) | (size & 0x0f)
+	size >>= 4
+	header = []
+	while size:
+		header.append(chr(byte | 0x80))
+		byte = size & 0x7f
+		size >>= 7
+	header.append(chr(byte))
+	return ''.join(header)
+
+def unpack_ofs_delta_offset(data, pos):
+	"""Parse the base offset of an OFS_DELTA entry, starting at pos. Returns the
+	offset relative to the entry and the position following it."""
+	byte = ord(data[pos])
+	offset = byte & 0x7f
+	pos += 1
+	while byte & 0x80:
+		byte = ord(data[pos])
+		offset = ((offset + 1) << 7) | (byte & 0x7f)
+		pos += 1
+	return offset, pos
+
+def unpack_delta_size(delta, pos):
+	"""Parse one of the sizes at the start of a delta, starting at pos. Returns the
+	size and the position following it."""
+	size = 0
+	shift = 0
+	while True:
+		byte = ord(delta[pos])
+		size |= (byte & 0x7f) << shift
+		shift += 7
+		pos += 1
+		if not byte & 0x80: return size, pos
+
+def iter_missing_objects(object_store, wants, have):
+	"""Iterate over all objects reachable from wants in object_store, yielding
+	(object, path) tuples. Objects for which have(sha) is true are skipped and not
+	descended into.
+
+	Unlike dulwich's MissingObjectFinder, this skips trees and blobs the other side
+	has as well, not only commits. Objects missing from object_store do not matter
+	as long as the other side has them, e.g. blobs never fetched into a partial
+	clone. Other missing objects raise a KeyError."""
+	seen = set()
+	todo = [(sha, None) for sha in wants]
+
+	while todo:
+		sha, path = todo.pop()
+		if sha in seen or have(sha): continue
+		seen.add(sha)
+
+		obj = object_store[sha]
+		type_num = obj.get_type()
+
+		if Tree.type_num == type_num:
+			for name, mode, hexsha in obj.iteritems():
+				if S_ISGITLINK(mode): continue
+				todo.append((hexsha, os.path.join(path, name) if path else name))
+		elif Commit.type_num == type_num:
+			todo.append((obj.tree, None))
+			todo.extend((parent, None) for parent in obj.parents)
+		elif Tag.type_num == type_num:
+			todo.append((obj.object[1], None))
+
+		yield obj, path
+
+def write_objects_pack(add_pack, objects):
+	"""Write (object, path) tuples into a new pack, created by calling add_pack.
+
+	Objects are compressed into a temporary file as they come in, so only one of them
+	is held in memory at a time. Returns the result of the pack's commit function, or
+	None if there were no objects."""
+	spool = tempfile.TemporaryFile()
+	num_objects = 0
+	for obj, path in objects:
+		raw = obj.as_raw_string()
+		spool.write(pack_entry_header(obj.get_type(), len(raw)))
+		spool.write(zlib.compress(raw))
+		num_objects += 1
+
+	if not num_objects:
+		spool.close()
+		return None
+
+	log.debug('Writing pack with %d objects' % num_objects)
+	f, commit = add_pack()
+	header = 'PACK' + struct.pack('>LL', 2, num_objects)
+	checksum = hashlib.sha1(header)
+	f.write(header)
+
+	spool.seek(0)
+	for chunk in iter(lambda: spool.read(64 * 1024), ''):
+		checksum.update(chunk)
+		f.write(chunk)
+	spool.close()
+
+	f.write(checksum.digest())
+	return commit()
+
 def calc_object_path(prefix, hexsha):
 	path = '%sobjects/%s/%s' % (prefix, hexsha[0:2], hexsha[2:40])
 	return path
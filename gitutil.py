@@ -137,6 +137,15 @@ def multiline_command(f):
 	wrapper.is_git_multiline = True
 	return wrapper
 
+def parse_fetch_line(line):
+	"""Parse a line of a "fetch" command batch into a (sha1, name) tuple. name is
+	None if git did not send one."""
+	args = line.rstrip().split(' ')
+	assert('fetch' == args.pop(0))
+	sha1 = args.pop(0)
+	name = args.pop(0) if args else None
+	return sha1, name
+
 s3_url_exp = 's3://(?:(?P<key>[^:@]+)(?::(?P<secret>[^@]*))?@)?(?P<bucket>[^:@]+)(?::(?P<prefix>[^@]*))?$'
 """Regular expression used for matching S3 URLs.
 
@@ -180,3 +189,45 @@ def merge_git_config(config_files = ['.git/config', '~/.gitconfig', '/etc/gitcon
 				conf.setdefault(sect, {})[key] = value
 
 	return conf
+
+
+def set_git_config_defaults(config_file, values):
+	"""Writes values missing from a git configuration file. values is a dictionary
+	with (section, key) tuples as keys.
+
+	Entries already present are never overwritten, the file is only written if
+	anything was added."""
+	p = git.config.GitConfigParser(os.path.expanduser(config_file), read_only = False)
+	changed = False
+	for (sect, key), value in values.iteritems():
+		if p.has_option(sect, key): continue
+		p.set_value(sect, key, value)
+		changed = True
+
+	if changed: p.write()
+	del p
+
+
+blob_filter_exp = 'blob:limit=(?P<size>[0-9]+)(?P<unit>[kKmMgG]?)$'
+"""Regular expression used for matching blob:limit filter specs."""
+
+
+blob_filter_re = re.compile(blob_filter_exp)
+"""Compiled version of blob_filter_exp."""
+
+
+blob_filter_units = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_blob_filter(spec):
+	"""Parse an object filter, as sent by git with the "filter" option (see
+	git-rev-list (1), --filter) and return the blob size limit it describes.
+
+	Blobs of at least the returned size in bytes are to be omitted. Only blob:none
+	(a limit of 0) and blob:limit=<n>[kmg] are supported, other filters raise a
+	HandlerException."""
+	if 'blob:none' == spec: return 0
+
+	m = blob_filter_re.match(spec)
+	if not m: raise HandlerException('Unsupported object filter: %s' % spec)
+	return int(m.group('size')) * blob_filter_units[m.group('unit').lower()]
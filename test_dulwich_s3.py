@@ -0,0 +1,383 @@
+import random
+import struct
+import unittest
+import zlib
+from binascii import hexlify, unhexlify
+from cStringIO import StringIO
+from hashlib import sha1
+
+from dulwich.objects import Blob, Commit, Tag, Tree
+from dulwich.pack import PackData, write_pack_index_v2, OFS_DELTA, REF_DELTA
+
+from dulwich_s3 import S3ObjectStore, pack_entry_header, unpack_entry_header, unpack_ofs_delta_offset,\
+                       unpack_delta_size, iter_missing_objects, write_objects_pack
+
+
+class FakeKey(object):
+	def __init__(self, bucket, name):
+		self.bucket = bucket
+		self.name = name
+
+	@property
+	def size(self):
+		return len(self.bucket.files[self.name])
+
+	def get_contents_as_string(self, headers = None):
+		data = self.bucket.files[self.name]
+		if headers and 'Range' in headers:
+			start, end = map(int, headers['Range'][len('bytes='):].split('-'))
+			self.bucket.requests.append((self.name, start, end + 1))
+			return data[start:end + 1]
+		self.bucket.requests.append((self.name, 0, len(data)))
+		return data
+
+	def get_contents_to_file(self, f):
+		f.write(self.bucket.files[self.name])
+
+
+class FakeBucket(object):
+	"""In-memory stand-in for a boto bucket, recording all ranged requests."""
+	def __init__(self):
+		self.files = {}
+		self.requests = []
+
+	def new_key(self, name):
+		return FakeKey(self, name)
+
+	def get_key(self, name):
+		if name in self.files: return FakeKey(self, name)
+
+	def get_all_keys(self, prefix = ''):
+		return [FakeKey(self, name) for name in sorted(self.files) if name.startswith(prefix)]
+
+
+class FakeS3ObjectStore(S3ObjectStore):
+	# pack loading independent of the pack cache of the installed dulwich version
+	@property
+	def packs(self):
+		if not hasattr(self, '_test_packs'): self._test_packs = self._load_packs()
+		return self._test_packs
+
+
+def encode_size(size):
+	out = []
+	while True:
+		byte = size & 0x7f
+		size >>= 7
+		if not size:
+			out.append(chr(byte))
+			return ''.join(out)
+		out.append(chr(byte | 0x80))
+
+def encode_ofs_delta_offset(offset):
+	out = [chr(offset & 0x7f)]
+	offset >>= 7
+	while offset:
+		offset -= 1
+		out.insert(0, chr(0x80 | (offset & 0x7f)))
+		offset >>= 7
+	return ''.join(out)
+
+def make_delta(base, target):
+	# a delta consisting of insert instructions only
+	out = [encode_size(len(base)), encode_size(len(target))]
+	for i in xrange(0, len(target), 127):
+		chunk = target[i:i + 127]
+		out.append(chr(len(chunk)) + chunk)
+	return ''.join(out)
+
+def random_blob(size, seed):
+	rnd = random.Random(seed)
+	return Blob.from_string(''.join(chr(rnd.randint(0, 255)) for _ in xrange(size)))
+
+def build_pack(bucket, name, entries):
+	"""Store a pack and its index in bucket. entries are objects, or tuples of
+	(OFS_DELTA or REF_DELTA, index of the base entry, object). Returns the offsets of
+	all entries."""
+	data = 'PACK' + struct.pack('>LL', 2, len(entries))
+	offsets = []
+	index = []
+	for entry in entries:
+		offset = len(data)
+		if isinstance(entry, tuple):
+			kind, base_index, obj = entry
+			base = entries[base_index]
+			if isinstance(base, tuple): base = base[2]
+			delta = make_delta(base.as_raw_string(), obj.as_raw_string())
+			header = pack_entry_header(kind, len(delta))
+			if OFS_DELTA == kind:
+				header += encode_ofs_delta_offset(offset - offsets[base_index])
+			else:
+				header += unhexlify(base.id)
+			raw_entry = header + zlib.compress(delta)
+		else:
+			obj = entry
+			raw = obj.as_raw_string()
+			raw_entry = pack_entry_header(obj.get_type(), len(raw)) + zlib.compress(raw)
+
+		offsets.append(offset)
+		index.append((unhexlify(obj.id), offset, zlib.crc32(raw_entry) & 0xffffffff))
+		data += raw_entry
+
+	checksum = sha1(data).digest()
+	bucket.files['objects/pack/%s.pack' % name] = data + checksum
+
+	idx = StringIO()
+	write_pack_index_v2(idx, sorted(index), checksum)
+	bucket.files['objects/pack/%s.idx' % name] = idx.getvalue()
+	return offsets
+
+
+class TestPackEntryParsing(unittest.TestCase):
+	def test_entry_header_roundtrip(self):
+		for type_num, size in [(1, 0), (2, 15), (3, 16), (4, 2 ** 20 + 3), (3, 2 ** 33)]:
+			header = pack_entry_header(type_num, size)
+			self.assertEqual(unpack_entry_header(header + 'x'), (type_num, size, len(header)))
+
+	def test_ofs_delta_offset(self):
+		for offset in [1, 127, 128, 16511, 16512, 2 ** 30]:
+			encoded = encode_ofs_delta_offset(offset)
+			self.assertEqual(unpack_ofs_delta_offset('xx' + encoded, 2), (offset, 2 + len(encoded)))
+
+	def test_delta_size(self):
+		encoded = encode_size(300) + encode_size(5)
+		size, pos = unpack_delta_size(encoded, 0)
+		self.assertEqual(size, 300)
+		self.assertEqual(unpack_delta_size(encoded, pos), (5, len(encoded)))
+
+
+class TestS3Pack(unittest.TestCase):
+	def setUp(self):
+		self.bucket = FakeBucket()
+		self.small1 = Blob.from_string('first small blob\n')
+		self.large = random_blob(5000, 1)
+		self.small2 = Blob.from_string('second small blob\n')
+		self.large_ofs = random_blob(3000, 2)
+		self.large_ref = random_blob(4000, 3)
+		self.offsets = build_pack(self.bucket, 'pack-test', [
+			self.small1,
+			self.large,
+			self.small2,
+			(OFS_DELTA, 1, self.large_ofs),
+			(REF_DELTA, 0, self.large_ref),
+		])
+		self.pack = self.open_pack()
+
+	def open_pack(self):
+		store = FakeS3ObjectStore(lambda: self.bucket, '')
+		pack = store.packs[0]
+		# the index is downloaded in full, only pack requests are of interest
+		pack.index
+		del self.bucket.requests[:]
+		return pack
+
+	def test_entry_boundaries(self):
+		for i, offset in enumerate(self.offsets[:-1]):
+			self.assertEqual(self.pack._entry_end(offset), self.offsets[i + 1])
+		self.assertEqual(self.pack._entry_end(self.offsets[-1]), self.pack.size - 20)
+
+	def test_prefetch_merges_nearby_entries(self):
+		self.pack.max_range_gap = 6000
+		self.pack.prefetch([self.offsets[0], self.offsets[2]])
+		self.assertEqual(self.bucket.requests, [('objects/pack/pack-test.pack', self.offsets[0], self.offsets[3])])
+
+		self.assertEqual(self.pack.get_raw_ranged(self.offsets[0]), (Blob.type_num, self.small1.as_raw_string()))
+		self.assertEqual(self.pack.get_raw_ranged(self.offsets[2]), (Blob.type_num, self.small2.as_raw_string()))
+		self.assertEqual(len(self.bucket.requests), 1)
+
+	def test_prefetch_keeps_distant_entries_apart(self):
+		self.pack.max_range_gap = 100
+		self.pack.prefetch([self.offsets[0], self.offsets[2]])
+		self.assertEqual([r[1:] for r in self.bucket.requests], [
+			(self.offsets[0], self.offsets[1]),
+			(self.offsets[2], self.offsets[3]),
+		])
+
+	def test_prefetch_skips_cached_entries(self):
+		self.pack.prefetch([self.offsets[0]])
+		self.pack.prefetch([self.offsets[0]])
+		self.assertEqual(len(self.bucket.requests), 1)
+
+	def test_prefetch_probe(self):
+		self.pack.prefetch([self.offsets[1]], probe = 64)
+		self.assertEqual([r[1:] for r in self.bucket.requests], [(self.offsets[1], self.offsets[1] + 64)])
+
+	def test_prefetch_readahead(self):
+		self.pack.readahead = 1000
+		self.pack.prefetch([self.offsets[0]], readahead = True)
+		self.assertEqual([r[1:] for r in self.bucket.requests], [(self.offsets[0], self.offsets[0] + 1000)])
+
+	def test_readahead_covers_following_entries(self):
+		self.pack.readahead = self.offsets[3]
+		self.pack.prefetch([self.offsets[0]], readahead = True)
+		self.pack.get_raw_ranged(self.offsets[2])
+		self.assertEqual(len(self.bucket.requests), 1)
+
+	def test_readahead_stops_at_pack_end(self):
+		self.pack.readahead = 10 ** 6
+		self.pack.prefetch([self.offsets[-1]], readahead = True)
+		self.assertEqual([r[1:] for r in self.bucket.requests], [(self.offsets[-1], self.pack.size - 20)])
+
+	def test_resolve_deltas(self):
+		self.assertEqual(self.pack.get_raw_ranged(self.offsets[3]), (Blob.type_num, self.large_ofs.as_raw_string()))
+		self.assertEqual(self.pack.get_raw_ranged(self.offsets[4]), (Blob.type_num, self.large_ref.as_raw_string()))
+
+	def test_decoded_entries_are_dropped(self):
+		self.pack.get_raw_ranged(self.offsets[3])
+		self.assertFalse(self.offsets[3] in self.pack._entries)
+
+		self.pack.drop_prefetched()
+		self.assertEqual(self.pack._entries, {})
+
+	def test_size(self):
+		self.assertEqual(self.pack.get_size_ranged(self.offsets[0]), len(self.small1.as_raw_string()))
+		self.assertEqual(self.pack.get_size_ranged(self.offsets[1]), 5000)
+
+	def test_size_of_deltas(self):
+		self.assertEqual(self.pack.get_size_ranged(self.offsets[3]), 3000)
+		self.assertEqual(self.pack.get_size_ranged(self.offsets[4]), 4000)
+
+	def test_size_reads_only_probe(self):
+		for offset in self.offsets[1], self.offsets[3], self.offsets[4]:
+			del self.bucket.requests[:]
+			self.pack.get_size_ranged(offset)
+			self.assertEqual([r[1:] for r in self.bucket.requests], [(offset, offset + self.pack.size_probe)])
+			self.assertFalse(offset in self.pack._entries)
+
+
+class TestFilteredObjects(unittest.TestCase):
+	def setUp(self):
+		self.bucket = FakeBucket()
+
+		self.small = Blob.from_string('small\n')
+		self.small2 = Blob.from_string('small, changed\n')
+		self.large = random_blob(2000, 4)
+		self.large_nested = random_blob(3000, 5)
+		self.tagged_large = random_blob(2500, 6)
+
+		self.subtree = Tree()
+		self.subtree.add('nested.bin', 0100644, self.large_nested.id)
+		self.tree1 = Tree()
+		self.tree1.add('small.txt', 0100644, self.small.id)
+		self.tree1.add('large.bin', 0100644, self.large.id)
+		self.tree1.add('sub', 040000, self.subtree.id)
+		self.tree2 = Tree()
+		self.tree2.add('small.txt', 0100644, self.small2.id)
+		self.tree2.add('large.bin', 0100644, self.large.id)
+		self.tree2.add('sub', 040000, self.subtree.id)
+
+		self.commit1 = self.make_commit(self.tree1, [])
+		self.commit2 = self.make_commit(self.tree2, [self.commit1.id])
+
+		self.tag = Tag()
+		self.tag.name = 'asset'
+		self.tag.object = (Blob, self.tagged_large.id)
+		self.tag.tagger = 'Someone <someone@example.com>'
+		self.tag.tag_time = 0
+		self.tag.tag_timezone = 0
+		self.tag.message = 'a tagged blob\n'
+
+		build_pack(self.bucket, 'pack-test', [
+			self.commit2, self.commit1, self.tag,
+			self.tree2, self.small2, self.large,
+			self.tree1, self.small, self.subtree, self.large_nested,
+			self.tagged_large,
+		])
+		self.store = FakeS3ObjectStore(lambda: self.bucket, '')
+
+	def make_commit(self, tree, parents):
+		commit = Commit()
+		commit.tree = tree.id
+		commit.parents = parents
+		commit.author = commit.committer = 'Someone <someone@example.com>'
+		commit.author_time = commit.commit_time = 0
+		commit.author_timezone = commit.commit_timezone = 0
+		commit.message = 'commit\n'
+		return commit
+
+	def filtered(self, wants, blob_limit, have = lambda sha: False):
+		objects = list(self.store.iter_filtered_objects(wants, have, blob_limit))
+		for obj, path in objects:
+			self.assertEqual(obj.as_raw_string(), self.store[obj.id].as_raw_string())
+		return set(obj.id for obj, path in objects)
+
+	def ids(self, *objs):
+		return set(obj.id for obj in objs)
+
+	def downloaded(self):
+		return sum(end - start for _, start, end in self.bucket.requests)
+
+	def disable_merging(self):
+		# the test pack is small enough to be read ahead completely
+		pack = self.store.packs[0]
+		pack.readahead = 0
+		pack.max_range_gap = 0
+
+	def test_unfiltered(self):
+		self.assertEqual(self.filtered([self.commit2.id], None), self.ids(
+			self.commit2, self.commit1, self.tree2, self.tree1, self.subtree,
+			self.small, self.small2, self.large, self.large_nested))
+
+	def test_blob_none(self):
+		self.assertEqual(self.filtered([self.commit2.id], 0), self.ids(
+			self.commit2, self.commit1, self.tree2, self.tree1, self.subtree))
+
+	def test_blob_none_does_not_download_blobs(self):
+		self.disable_merging()
+		self.filtered([self.commit2.id], 0)
+		self.assertTrue(self.downloaded() < 1000)
+
+	def test_blob_limit(self):
+		self.assertEqual(self.filtered([self.commit2.id], 1000), self.ids(
+			self.commit2, self.commit1, self.tree2, self.tree1, self.subtree, self.small, self.small2))
+
+	def test_blob_limit_does_not_download_large_blobs(self):
+		self.disable_merging()
+		self.filtered([self.commit2.id], 1000)
+		self.assertTrue(self.downloaded() < 2000)
+
+	def test_wanted_blobs(self):
+		self.assertEqual(self.filtered([self.large.id, self.large_nested.id], 0), self.ids(self.large, self.large_nested))
+
+	def test_wanted_blob_reachable_through_tree(self):
+		self.assertEqual(self.filtered([self.commit2.id, self.large_nested.id], 1000), self.ids(
+			self.commit2, self.commit1, self.tree2, self.tree1, self.subtree, self.small, self.small2, self.large_nested))
+
+	def test_have(self):
+		have = lambda sha: sha in self.ids(self.commit1, self.subtree)
+		self.assertEqual(self.filtered([self.commit2.id], 0, have), self.ids(self.commit2, self.tree2))
+
+	def test_tagged_blob_is_filtered(self):
+		self.assertEqual(self.filtered([self.tag.id], 0), self.ids(self.tag))
+		self.assertEqual(self.filtered([self.tag.id], 1000), self.ids(self.tag))
+		self.assertEqual(self.filtered([self.tag.id], 3000), self.ids(self.tag, self.tagged_large))
+
+	def test_write_objects_pack(self):
+		out = StringIO()
+		def add_pack():
+			return out, lambda: out.getvalue()
+
+		data = write_objects_pack(add_pack, self.store.iter_filtered_objects([self.commit2.id], lambda sha: False, 0))
+		pack = PackData.from_file(StringIO(data), len(data))
+		shas = set(sha if 40 == len(sha) else hexlify(sha) for sha, offset, crc32 in pack.sorted_entries())
+		self.assertEqual(shas, self.ids(
+			self.commit2, self.commit1, self.tree2, self.tree1, self.subtree))
+
+	def test_write_objects_pack_without_objects(self):
+		self.assertEqual(write_objects_pack(None, iter([])), None)
+
+	def test_missing_objects(self):
+		remote = self.ids(self.commit1, self.tree1, self.subtree, self.small, self.large, self.large_nested)
+		local = dict((obj.id, obj) for obj in [self.commit2, self.tree2, self.small2])
+
+		objects = iter_missing_objects(local, [self.commit2.id], remote.__contains__)
+		self.assertEqual(set(obj.id for obj, path in objects), self.ids(self.commit2, self.tree2, self.small2))
+
+	def test_missing_objects_not_on_remote(self):
+		local = dict((obj.id, obj) for obj in [self.commit2, self.tree2, self.small2])
+		objects = iter_missing_objects(local, [self.commit2.id], lambda sha: False)
+		self.assertRaises(KeyError, list, objects)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+from gitutil import HandlerException, parse_blob_filter, parse_fetch_line
+
+
+class TestParseBlobFilter(unittest.TestCase):
+	def test_accepted(self):
+		self.assertEqual(parse_blob_filter('blob:none'), 0)
+		self.assertEqual(parse_blob_filter('blob:limit=0'), 0)
+		self.assertEqual(parse_blob_filter('blob:limit=1000'), 1000)
+		self.assertEqual(parse_blob_filter('blob:limit=2k'), 2 * 1024)
+		self.assertEqual(parse_blob_filter('blob:limit=3M'), 3 * 1024 ** 2)
+		self.assertEqual(parse_blob_filter('blob:limit=1g'), 1024 ** 3)
+
+	def test_rejected(self):
+		for spec in ['tree:0', 'sparse:oid=1234', 'combine:blob:none+tree:1', 'blob:limit=',
+		             'blob:limit=1t', 'blob:limit=-1', 'blob:none ', 'object:type=blob']:
+			self.assertRaises(HandlerException, parse_blob_filter, spec)
+
+
+class TestParseFetchLine(unittest.TestCase):
+	def test_with_name(self):
+		self.assertEqual(parse_fetch_line('fetch 1234abcd refs/heads/master\n'), ('1234abcd', 'refs/heads/master'))
+
+	def test_without_name(self):
+		self.assertEqual(parse_fetch_line('fetch 1234abcd'), ('1234abcd', None))
+
+
+if __name__ == '__main__':
+	unittest.main()